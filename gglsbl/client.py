@@ -21,7 +21,7 @@ class SafeBrowsingList(object):
     """
 
     def __init__(self, api_key, db_path='/tmp/gsb_v4.db',
-                 discard_fair_use_policy=False, platforms=None, timeout=10):
+                 discard_fair_use_policy=False, platforms=None, timeout=10, cue_filter=False):
         """Constructor.
 
         Args:
@@ -30,9 +30,10 @@ class SafeBrowsingList(object):
             discard_fair_use_policy: boolean, disable request frequency throttling (only for testing).
             platforms: list, threat lists to look up, default includes all platforms.
             timeout: seconds to wait for Sqlite DB to become unlocked from concurrent WRITE transaction.
+            cue_filter: boolean, keep in-memory filter of hash prefixes to speed up lookups of clean URLs.
         """
         self.api_client = SafeBrowsingApiClient(api_key, discard_fair_use_policy=discard_fair_use_policy)
-        self.storage = SqliteStorage(db_path, timeout=timeout)
+        self.storage = SqliteStorage(db_path, timeout=timeout, cue_filter=cue_filter)
         self.platforms = platforms
 
     def _verify_threat_list_checksum(self, threat_list, remote_checksum):
@@ -42,10 +43,9 @@ class SafeBrowsingList(object):
     def update_hash_prefix_cache(self):
         """Update locally cached threat lists."""
         try:
-            self.storage.cleanup_full_hashes()
-            self.storage.commit()
+            with self.storage.transaction():
+                self.storage.cleanup_full_hashes()
             self._sync_threat_lists()
-            self.storage.commit()
             self._sync_hash_prefix_cache()
         except Exception:
             self.storage.rollback()
@@ -56,17 +56,18 @@ class SafeBrowsingList(object):
         for ts in self.storage.get_threat_lists():
             threat_lists_to_remove[repr(ts)] = ts
         threat_lists = self.api_client.get_threats_lists()
-        for entry in threat_lists:
-            threat_list = ThreatList.from_api_entry(entry)
-            if self.platforms is None or threat_list.platform_type in self.platforms:
-                self.storage.add_threat_list(threat_list)
-                try:
-                    del threat_lists_to_remove[repr(threat_list)]
-                except KeyError:
-                    pass
-        for ts in threat_lists_to_remove.values():
-            self.storage.delete_hash_prefix_list(ts)
-            self.storage.delete_threat_list(ts)
+        with self.storage.transaction():
+            for entry in threat_lists:
+                threat_list = ThreatList.from_api_entry(entry)
+                if self.platforms is None or threat_list.platform_type in self.platforms:
+                    self.storage.add_threat_list(threat_list)
+                    try:
+                        del threat_lists_to_remove[repr(threat_list)]
+                    except KeyError:
+                        pass
+            for ts in threat_lists_to_remove.values():
+                self.storage.delete_hash_prefix_list(ts)
+                self.storage.delete_threat_list(ts)
         del threat_lists_to_remove
 
     def _sync_hash_prefix_cache(self):
@@ -74,22 +75,25 @@ class SafeBrowsingList(object):
         for response in self.api_client.get_threats_update(client_state):
             response_threat_list = ThreatList(response['threatType'], response['platformType'],
                                               response['threatEntryType'])
-            if response['responseType'] == 'FULL_UPDATE':
-                self.storage.delete_hash_prefix_list(response_threat_list)
-            for r in response.get('removals', []):
-                self.storage.remove_hash_prefix_indices(response_threat_list, r['rawIndices']['indices'])
-            for a in response.get('additions', []):
-                hash_prefix_list = HashPrefixList(a['rawHashes']['prefixSize'], b64decode(a['rawHashes']['rawHashes']))
-                self.storage.populate_hash_prefix_list(response_threat_list, hash_prefix_list)
-            expected_checksum = b64decode(response['checksum']['sha256'])
-            log.info('Verifying threat hash prefix list checksum')
-            if self._verify_threat_list_checksum(response_threat_list, expected_checksum):
-                log.info('Local cache checksum matches the server: {}'.format(to_hex(expected_checksum)))
-                self.storage.update_threat_list_client_state(response_threat_list, response['newClientState'])
-                self.storage.commit()
-            else:
-                raise Exception('Local cache checksum does not match the server: '
-                                '"{}". Consider removing {}'.format(to_hex(expected_checksum), self.storage.db_path))
+            with self.storage.transaction():
+                self._apply_threat_list_update(response_threat_list, response)
+
+    def _apply_threat_list_update(self, response_threat_list, response):
+        if response['responseType'] == 'FULL_UPDATE':
+            self.storage.delete_hash_prefix_list(response_threat_list)
+        for r in response.get('removals', []):
+            self.storage.remove_hash_prefix_indices(response_threat_list, r['rawIndices']['indices'])
+        for a in response.get('additions', []):
+            hash_prefix_list = HashPrefixList(a['rawHashes']['prefixSize'], b64decode(a['rawHashes']['rawHashes']))
+            self.storage.populate_hash_prefix_list(response_threat_list, hash_prefix_list)
+        expected_checksum = b64decode(response['checksum']['sha256'])
+        log.info('Verifying threat hash prefix list checksum')
+        if self._verify_threat_list_checksum(response_threat_list, expected_checksum):
+            log.info('Local cache checksum matches the server: {}'.format(to_hex(expected_checksum)))
+            self.storage.update_threat_list_client_state(response_threat_list, response['newClientState'])
+        else:
+            raise Exception('Local cache checksum does not match the server: '
+                            '"{}". Consider removing {}'.format(to_hex(expected_checksum), self.storage.db_path))
 
     def _sync_full_hashes(self, hash_prefixes):
         """Download full hashes matching hash_prefixes.
@@ -101,6 +105,7 @@ class SafeBrowsingList(object):
 
         # update negative cache for each hash prefix
         # store full hash (insert or update) with positive cache bumped up
+        full_hashes = []
         for m in fh_response.get('matches', []):
             threat_list = ThreatList(m['threatType'], m['platformType'], m['threatEntryType'])
             hash_value = b64decode(m['threat']['hash'])
@@ -111,11 +116,13 @@ class SafeBrowsingList(object):
                 v = b64decode(metadata['value'])
                 if k == 'malware_threat_type':
                     malware_threat_type = v
-            self.storage.store_full_hash(threat_list, hash_value, cache_duration, malware_threat_type)
+            full_hashes.append((threat_list, hash_value, cache_duration, malware_threat_type))
 
         negative_cache_duration = int(fh_response['negativeCacheDuration'].rstrip('s'))
-        for prefix_value in hash_prefixes:
-            self.storage.update_hash_prefix_expiration(prefix_value, negative_cache_duration)
+        # lookups read through separate connections and only see committed data
+        with self.storage.transaction():
+            self.storage.store_full_hashes(full_hashes)
+            self.storage.update_hash_prefix_expirations(hash_prefixes, negative_cache_duration)
 
     def lookup_url(self, url):
         """Look up specified URL in Safe Browsing threat lists."""
@@ -124,12 +131,7 @@ class SafeBrowsingList(object):
         if not url.strip():
             raise ValueError("Empty input string.")
         url_hashes = URL(url).hashes
-        try:
-            list_names = self._lookup_hashes(url_hashes)
-            self.storage.commit()
-        except Exception:
-            self.storage.rollback()
-            raise
+        list_names = self._lookup_hashes(url_hashes)
         if list_names:
             return list_names
         return None
@@ -140,7 +142,8 @@ class SafeBrowsingList(object):
         Returns names of lists it was found in.
         """
         full_hashes = list(full_hashes)
-        cues = [fh[0:4] for fh in full_hashes]
+        # URL permutations often share a cue, look up each of them only once
+        cues = sorted({fh[0:4] for fh in full_hashes})
         result = []
         matching_prefixes = {}
         matching_full_hashes = set()
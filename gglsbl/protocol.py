@@ -39,6 +39,10 @@ log.addHandler(logging.NullHandler())
 
 _fail_count = 0
 
+# compiled once, canonicalization runs for every looked up URL
+_CONSECUTIVE_DOTS_RE = re.compile(br'\.+')
+_IPV4_RE = re.compile(r'\d+\.\d+\.\d+\.\d+')
+
 
 def autoretry(func):
     @wraps(func)
@@ -225,7 +229,7 @@ class URL(object):
             return urllib.quote(s, safe=safe_chars)
 
         url = self.url.strip()
-        url = url.replace(b'\n', b'').replace(b'\r', b'').replace(b'\t', b'')
+        url = url.translate(None, b'\n\r\t')
         url = url.split(b'#', 1)[0]
         if url.startswith(b'//'):
             url = b'http:' + url
@@ -259,7 +263,9 @@ class URL(object):
             path = path + b'/'
         port = url_parts.port
         host = host.strip(b'.')
-        host = re.sub(br'\.+', b'.', host).lower()
+        if b'..' in host:
+            host = _CONSECUTIVE_DOTS_RE.sub(b'.', host)
+        host = host.lower()
         if host.isdigit():
             try:
                 host = socket.inet_ntoa(struct.pack("!I", int(host)))
@@ -286,7 +292,7 @@ class URL(object):
         to blacklisted URLs
         """
         def url_host_permutations(host):
-            if re.match(r'\d+\.\d+\.\d+\.\d+', host):
+            if _IPV4_RE.match(host):
                 yield host
                 return
             parts = host.split('.')
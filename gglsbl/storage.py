@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
 import os
+import struct
 import hashlib
+import operator
+import functools
 import contextlib
 import sqlite3
 import logging
+import threading
+import time
+from collections import namedtuple
+from urllib.request import pathname2url
 
 from gglsbl.utils import to_hex
 
@@ -13,21 +20,40 @@ log = logging.getLogger('gglsbl')
 log.addHandler(logging.NullHandler())
 
 
-class ThreatList(object):
-    """Represents threat list name."""
+@functools.lru_cache(maxsize=256)
+def _sql_with_placeholders(q, count):
+    """Substitute IN ({}) clause of the query with specified number of bind parameter placeholders."""
+    return q.format(','.join(['?'] * count))
 
-    def __init__(self, threat_type, platform_type, threat_entry_type):
-        """Constructor."""
-        self.threat_type = threat_type
-        self.platform_type = platform_type
-        self.threat_entry_type = threat_entry_type
+
+def _padded_batches(values, batch_size=512):
+    """Split values into batches padded with None to the next power of two length.
+
+    NULL never matches IN (...), padding only keeps the number of distinct statement texts small
+    so they all stay in the connection's statement cache.
+    """
+    for i in range(0, len(values), batch_size):
+        batch = values[i:(i + batch_size)]
+        padding = (1 << (len(batch) - 1).bit_length()) - len(batch)
+        if padding:
+            batch.extend([None] * padding)
+        yield batch
+
+
+class ThreatList(namedtuple('ThreatList', ['threat_type', 'platform_type', 'threat_entry_type'])):
+    """Represents threat list name.
+
+    Being a tuple it is cheap to create for every looked up row, and compares and hashes by value.
+    """
+
+    __slots__ = ()
 
     @classmethod
     def from_api_entry(cls, entry):
         return cls(entry['threatType'], entry['platformType'], entry['threatEntryType'])
 
     def as_tuple(self):
-        return (self.threat_type, self.platform_type, self.threat_entry_type)
+        return tuple(self)
 
     def __repr__(self):
         """String representation of object"""
@@ -43,34 +69,94 @@ class HashPrefixList(object):
         :param prefix_size: size of hash prefix in bytes (typically 4, sometimes 6)
         :param raw_hashes: string consisting of concatenated hash prefixes.
         """
-        self.prefix_size = prefix_size
+        self.prefix_size = int(prefix_size)
         self.raw_hashes = raw_hashes
+        self._len = len(raw_hashes) // self.prefix_size
 
     def __len__(self):
         """Number of individual hash prefixes in the list."""
-        return int(len(self.raw_hashes) / self.prefix_size)
+        return self._len
 
     def __iter__(self):
         """Iterate through concatenated raw hashes."""
-        n = self.prefix_size
-        return (self.raw_hashes[i:i + n] for i in range(0, len(self.raw_hashes), n))
+        # struct splits the buffer in C, without running Python bytecode for each prefix
+        return map(operator.itemgetter(0), struct.iter_unpack('{}s'.format(self.prefix_size), self.raw_hashes))
 
 
 class SqliteStorage(object):
     """Storage abstraction for local GSB cache."""
 
-    schema_version = '1.1'
+    schema_version = '1.9'
 
-    def __init__(self, db_path, timeout=10):
+    # SQL of the hot lookup and caching paths, kept constant so sqlite3 statement cache can reuse compiled statements
+    _LOOKUP_FULL_HASHES_SQL = '''SELECT threat_type,platform_type,threat_entry_type,
+                    expires_at < current_timestamp AS has_expired
+                FROM full_hash WHERE value IN ({})
+    '''
+    _LOOKUP_HASH_PREFIX_SQL = '''SELECT value, MAX(negative_expires_at < current_timestamp) AS negative_cache_expired
+                FROM hash_prefix WHERE cue IN ({}) GROUP BY 1
+    '''
+    # UPSERT needs SQLite 3.24+, checked in constructor
+    _STORE_FULL_HASH_SQL = '''INSERT INTO full_hash
+                    (value, threat_type, platform_type, threat_entry_type, malware_threat_type,
+                     downloaded_at, expires_at)
+                VALUES
+                    (?, ?, ?, ?, ?, current_timestamp, datetime(current_timestamp, ? || ' SECONDS'))
+                ON CONFLICT (value, threat_type, platform_type, threat_entry_type) DO UPDATE
+                    SET expires_at=excluded.expires_at, malware_threat_type=excluded.malware_threat_type
+    '''
+    # hash_prefix is keyed by threat list first, cues let the update go through idx_hash_prefix_cue instead
+    _UPDATE_HASH_PREFIX_EXPIRATION_SQL = '''UPDATE hash_prefix
+                SET negative_expires_at=datetime(current_timestamp, ? || ' SECONDS')
+                WHERE cue IN ({0}) AND value IN ({0})
+    '''
+    # bumped whenever hash prefixes are added or removed, tells cue filter when to rebuild
+    _HASH_PREFIX_GENERATION_SQL = "SELECT CAST(value AS INTEGER) FROM metadata WHERE name='hash_prefix_generation'"
+    # hash_prefix rows refer to their threat list by integer id, resolved from list name with this subquery
+    _THREAT_LIST_ID_SQL = '''(SELECT id FROM threat_list
+                WHERE threat_type=? AND platform_type=? AND threat_entry_type=?)'''
+
+    # cue filter is a bitmap addressed by this many leading bits of the cue (2**26 bits take 8MB of memory)
+    _cue_filter_bits = 26
+    # seconds to serve threat_list rows from memory before re-reading them
+    _threat_list_cache_ttl = 60
+
+    def __init__(self, db_path, timeout=10, wal=True, cue_filter=False):
         """Constructor.
 
-        :param db_path: path to Sqlite DB file
+        :param db_path: path to Sqlite DB file, in-memory DBs are not supported as lookups
+            open their own read-only connections to the same file
         :timeout: Sqlite lock wait timeout in seconds
+        :param wal: use write-ahead log, SQLite checkpoints it automatically but long-running
+            applications may also run "PRAGMA wal_checkpoint(TRUNCATE)" periodically to keep the -wal file small
+        :param cue_filter: keep in-memory filter of known hash prefix cues which lets most of the lookups of
+            clean URLs skip the DB, worth it for long-running processes doing many lookups
         """
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            raise RuntimeError('SQLite 3.24.0 or newer is required, Python is linked against SQLite {}'.format(
+                sqlite3.sqlite_version))
+        if db_path in ('', ':memory:'):
+            raise ValueError('SqliteStorage needs a DB file, in-memory or temporary DBs are not supported')
         self.db_path = db_path
+        self.timeout = timeout
+        self.wal = wal
+        self.cue_filter = cue_filter
+        # (hash prefix generation, bitmap) pair, replaced as a whole so lookups can read it without locking
+        self._cue_filter = None
+        self._cue_filter_db = None
+        self._cue_filter_lock = threading.Lock()
+        # threat lists rarely change, writes through this instance reset the cache,
+        # changes made by other processes sharing the DB file are picked up once it expires
+        self._threat_list_cache = None
+        self._threat_list_cache_expires_at = 0
+        # all writes go through the single self.db connection, lookups use per-thread connections
+        self._write_lock = threading.RLock()
+        # nesting level of transaction() blocks, only the outermost one commits
+        self._transaction_depth = 0
+        self._thread_local = threading.local()
         do_init_db = not os.path.isfile(db_path)
         log.info('Opening SQLite DB {}'.format(db_path))
-        self.db = sqlite3.connect(db_path, timeout)
+        self.db = self._connect()
         if do_init_db:
             log.info('SQLite DB does not exist, initializing')
             self.init_db()
@@ -78,35 +164,125 @@ class SqliteStorage(object):
             log.warning("Cache schema is not compatible with this library version. Re-creating sqlite DB %s", db_path)
             self.db.close()
             os.unlink(db_path)
-            self.db = sqlite3.connect(db_path, timeout)
+            self.db = self._connect()
             self.init_db()
-        self.db.cursor().execute('PRAGMA synchronous = 0')
-        self.db.cursor().execute('PRAGMA journal_mode = WAL')
+
+    def _connect(self, read_only=False):
+        if read_only:
+            # autocommit, so that an idle lookup connection never holds a read transaction open
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self.db_path)))
+            db = sqlite3.connect(uri, self.timeout, isolation_level=None, check_same_thread=False,
+                                 cached_statements=256, uri=True)
+        else:
+            db = sqlite3.connect(self.db_path, self.timeout, check_same_thread=False, cached_statements=256)
+            if self.wal:
+                db.execute('PRAGMA journal_mode = WAL')
+                # in WAL mode NORMAL syncs only on checkpoint, cheap and still safe against corruption
+                db.execute('PRAGMA synchronous = NORMAL')
+            else:
+                # journal mode is persistent, switch back a DB that has been opened with WAL before
+                db.execute('PRAGMA journal_mode = DELETE')
+                db.execute('PRAGMA synchronous = 0')
+        db.execute('PRAGMA cache_size = -65536')
+        db.execute('PRAGMA temp_store = MEMORY')
+        db.execute('PRAGMA mmap_size = 268435456')
+        return db
+
+    def _read_connection(self):
+        """Read-only connection of the current thread, lets lookups run concurrently with each other and the writer."""
+        db = getattr(self._thread_local, 'db', None)
+        if db is None:
+            db = self._connect(read_only=True)
+            self._thread_local.db = db
+        return db
+
+    def _get_cue_filter(self):
+        """Bitmap of cues known to hash_prefix table, rebuilt after hash prefixes are modified by any connection."""
+        generation = self._read_connection().execute(self._HASH_PREFIX_GENERATION_SQL).fetchone()[0]
+        cue_filter = self._cue_filter
+        if cue_filter is not None and cue_filter[0] >= generation:
+            return cue_filter[1]
+        with self._cue_filter_lock:
+            # another thread may have rebuilt the filter while this one was waiting for the lock
+            cue_filter = self._cue_filter
+            if cue_filter is not None and cue_filter[0] >= generation:
+                return cue_filter[1]
+            if self._cue_filter_db is None:
+                self._cue_filter_db = self._connect(read_only=True)
+            db = self._cue_filter_db
+            log.info('Building hash prefix cue filter')
+            shift = 32 - self._cue_filter_bits
+            bitmap = bytearray(1 << (self._cue_filter_bits - 3))
+            # read generation and cues from the same snapshot
+            db.execute('BEGIN')
+            try:
+                generation = db.execute(self._HASH_PREFIX_GENERATION_SQL).fetchone()[0]
+                dbc = db.execute('SELECT DISTINCT cue FROM hash_prefix')
+                while True:
+                    rows = dbc.fetchmany(8192)
+                    if not rows:
+                        break
+                    for (cue,) in rows:
+                        n = int.from_bytes(cue, 'big') >> shift
+                        bitmap[n >> 3] |= 1 << (n & 7)
+            finally:
+                db.execute('COMMIT')
+            self._cue_filter = (generation, bitmap)
+            return bitmap
 
     def check_schema_version(self):
+        qt = "SELECT 1 FROM sqlite_master WHERE type='table' AND name='metadata'"
         q = "SELECT value FROM metadata WHERE name='schema_version'"
         v = None
         with self.get_cursor() as dbc:
-            try:
-                dbc.execute(q)
-                v = dbc.fetchall()[0][0]
-            except sqlite3.OperationalError:
+            dbc.execute(qt)
+            if dbc.fetchone() is None:
                 log.error('Can not get schema version, it is probably outdated.')
                 return False
-        self.db.rollback()  # prevent dangling transaction while instance is idle after init
+            dbc.execute(q)
+            row = dbc.fetchone()
+            if row is not None:
+                v = row[0]
         return v == self.schema_version
 
     @contextlib.contextmanager
     def get_cursor(self):
-        dbc = self.db.cursor()
-        try:
-            yield dbc
-        finally:
-            dbc.close()
+        with self._write_lock:
+            dbc = self.db.cursor()
+            try:
+                yield dbc
+            finally:
+                dbc.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run a group of writes in a single transaction.
+
+        Commits on exit and rolls back if an exception is raised. Nested blocks join the outer one
+        and leave committing to it. Pending writes made outside of transaction() are committed
+        or rolled back together with the block.
+        """
+        with self._write_lock:
+            if self._transaction_depth:
+                self._transaction_depth += 1
+                try:
+                    yield
+                finally:
+                    self._transaction_depth -= 1
+                return
+            if not self.db.in_transaction:
+                self.db.execute('BEGIN IMMEDIATE')
+            self._transaction_depth = 1
+            try:
+                yield
+            except BaseException:
+                self.rollback()
+                raise
+            finally:
+                self._transaction_depth = 0
+            self.db.commit()
 
     def init_db(self):
-        self.db.cursor().execute('PRAGMA synchronous = 0')
-        self.db.cursor().execute('PRAGMA journal_mode = WAL')
         with self.get_cursor() as dbc:
             dbc.execute(
                 """CREATE TABLE metadata (
@@ -117,14 +293,19 @@ class SqliteStorage(object):
             dbc.execute(
                 """INSERT INTO metadata (name, value) VALUES ('schema_version', '{}')""".format(self.schema_version)
             )
+            dbc.execute(
+                """INSERT INTO metadata (name, value) VALUES ('hash_prefix_generation', 0)"""
+            )
             dbc.execute(
                 """CREATE TABLE threat_list (
+                id INTEGER PRIMARY KEY,
                 threat_type character varying(128) NOT NULL,
                 platform_type character varying(128) NOT NULL,
                 threat_entry_type character varying(128) NOT NULL,
                 client_state character varying(42),
+                checksum BLOB,
                 timestamp timestamp without time zone DEFAULT current_timestamp,
-                PRIMARY KEY (threat_type, platform_type, threat_entry_type)
+                UNIQUE (threat_type, platform_type, threat_entry_type)
                 )"""
             )
             dbc.execute(
@@ -137,135 +318,141 @@ class SqliteStorage(object):
                 expires_at timestamp without time zone NOT NULL DEFAULT current_timestamp,
                 malware_threat_type varchar(32),
                 PRIMARY KEY (value, threat_type, platform_type, threat_entry_type)
-                )"""
+                ) WITHOUT ROWID"""
             )
             dbc.execute(
                 """CREATE TABLE hash_prefix (
                 value BLOB NOT NULL,
                 cue BLOB NOT NULL,
-                threat_type character varying(128) NOT NULL,
-                platform_type character varying(128) NOT NULL,
-                threat_entry_type character varying(128) NOT NULL,
+                threat_list_id INTEGER NOT NULL REFERENCES threat_list(id) ON DELETE CASCADE,
                 timestamp timestamp without time zone DEFAULT current_timestamp,
                 negative_expires_at timestamp without time zone NOT NULL DEFAULT current_timestamp,
-                PRIMARY KEY (value, threat_type, platform_type, threat_entry_type),
-                FOREIGN KEY(threat_type, platform_type, threat_entry_type)
-                    REFERENCES threat_list(threat_type, platform_type, threat_entry_type)
-                    ON DELETE CASCADE
-                )
+                PRIMARY KEY (threat_list_id, value)
+                ) WITHOUT ROWID
                 """
             )
             dbc.execute(
-                """CREATE INDEX idx_hash_prefix_cue ON hash_prefix (cue)"""
-            )
-            dbc.execute(
-                """CREATE INDEX idx_hash_prefix_list ON hash_prefix (threat_type, platform_type, threat_entry_type)"""
+                """CREATE INDEX idx_hash_prefix_cue ON hash_prefix (cue, value, negative_expires_at)"""
             )
             dbc.execute(
                 """CREATE INDEX idx_full_hash_expires_at ON full_hash (expires_at)"""
             )
             dbc.execute(
-                """CREATE INDEX idx_full_hash_value ON full_hash (value)"""
+                """CREATE INDEX idx_full_hash_list ON full_hash (threat_type, platform_type, threat_entry_type)"""
             )
         self.db.commit()
 
     def lookup_full_hashes(self, hash_values):
-        """Query DB to see if hash is blacklisted"""
-        q = '''SELECT threat_type,platform_type,threat_entry_type, expires_at < current_timestamp AS has_expired
-                FROM full_hash WHERE value IN ({})
-        '''
+        """Query DB to see if hash is blacklisted
+
+        Any number of hashes can be looked up at once, they are sent to SQLite in batches.
+        """
+        q = self._LOOKUP_FULL_HASHES_SQL
+        hash_values = list(hash_values)
         output = []
-        with self.get_cursor() as dbc:
-            placeholders = ','.join(['?'] * len(hash_values))
-            dbc.execute(q.format(placeholders), [sqlite3.Binary(hv) for hv in hash_values])
-            for h in dbc.fetchall():
-                threat_type, platform_type, threat_entry_type, has_expired = h
-                threat_list = ThreatList(threat_type, platform_type, threat_entry_type)
-                output.append((threat_list, has_expired))
+        # hot path, skip the cursor context manager and let connection manage the cursor
+        execute = self._read_connection().execute
+        for lookup_batch in _padded_batches(hash_values):
+            for h in execute(_sql_with_placeholders(q, len(lookup_batch)), lookup_batch).fetchall():
+                output.append((ThreatList._make(h[:3]), h[3]))
         return output
 
     def lookup_hash_prefix(self, cues):
         """Lookup hash prefixes by cue (first 4 bytes of hash)
 
+        Any number of cues can be looked up at once, they are sent to SQLite in batches.
         Returns a tuple of (value, negative_cache_expired).
         """
-        q = '''SELECT value, MAX(negative_expires_at < current_timestamp) AS negative_cache_expired
-                FROM hash_prefix WHERE cue IN ({}) GROUP BY 1
-        '''
+        q = self._LOOKUP_HASH_PREFIX_SQL
+        cues = list(cues)
+        if self.cue_filter:
+            cue_filter = self._get_cue_filter()
+            shift = 32 - self._cue_filter_bits
+            known_cues = []
+            for cue in cues:
+                n = int.from_bytes(cue, 'big') >> shift
+                if cue_filter[n >> 3] & (1 << (n & 7)):
+                    known_cues.append(cue)
+            cues = known_cues
         output = []
-        with self.get_cursor() as dbc:
-            dbc.execute(q.format(','.join(['?'] * len(cues))), [sqlite3.Binary(cue) for cue in cues])
-            for h in dbc.fetchall():
-                value, negative_cache_expired = h
-                output.append((bytes(value), negative_cache_expired))
+        execute = self._read_connection().execute
+        # each value has exactly one cue, so grouping by value within a batch is final
+        for lookup_batch in _padded_batches(cues):
+            output.extend(execute(_sql_with_placeholders(q, len(lookup_batch)), lookup_batch).fetchall())
         return output
 
     def store_full_hash(self, threat_list, hash_value, cache_duration, malware_threat_type):
         """Store full hash found for the given hash prefix"""
-        log.info('Storing full hash %s to list %s with cache duration %s',
-                 to_hex(hash_value), str(threat_list), cache_duration)
-        qi = '''INSERT OR IGNORE INTO full_hash
-                    (value, threat_type, platform_type, threat_entry_type, malware_threat_type, downloaded_at)
-                VALUES
-                    (?, ?, ?, ?, ?, current_timestamp)
-        '''
-        qu = "UPDATE full_hash SET expires_at=datetime(current_timestamp, '+{} SECONDS') \
-            WHERE value=? AND threat_type=? AND platform_type=? AND threat_entry_type=?"
+        self.store_full_hashes([(threat_list, hash_value, cache_duration, malware_threat_type)])
 
-        i_parameters = [sqlite3.Binary(hash_value), threat_list.threat_type,
-                        threat_list.platform_type, threat_list.threat_entry_type, malware_threat_type]
-        u_parameters = [sqlite3.Binary(hash_value), threat_list.threat_type,
-                        threat_list.platform_type, threat_list.threat_entry_type]
+    def store_full_hashes(self, full_hashes):
+        """Store multiple full hashes at once.
+
+        :param full_hashes: iterable of (threat_list, hash_value, cache_duration, malware_threat_type) tuples
+        """
+        q = self._STORE_FULL_HASH_SQL
+        parameters = []
+        for threat_list, hash_value, cache_duration, malware_threat_type in full_hashes:
+            log.info('Storing full hash %s to list %s with cache duration %s',
+                     to_hex(hash_value), str(threat_list), cache_duration)
+            parameters.append((hash_value, threat_list.threat_type, threat_list.platform_type,
+                               threat_list.threat_entry_type, malware_threat_type, int(cache_duration)))
 
         with self.get_cursor() as dbc:
-            dbc.execute(qi, i_parameters)
-            dbc.execute(qu.format(int(cache_duration)), u_parameters)
+            dbc.executemany(q, parameters)
 
     def delete_hash_prefix_list(self, threat_list):
-        q = '''DELETE FROM hash_prefix
-                    WHERE threat_type=? AND platform_type=? AND threat_entry_type=?
-        '''
+        q = '''DELETE FROM hash_prefix WHERE threat_list_id={}'''.format(self._THREAT_LIST_ID_SQL)
         parameters = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
         with self.get_cursor() as dbc:
             dbc.execute(q, parameters)
+            self._hash_prefix_list_modified(dbc, threat_list)
 
     def cleanup_full_hashes(self, keep_expired_for=(60 * 60 * 12)):
         """Remove long expired full_hash entries."""
-        q = '''DELETE FROM full_hash WHERE expires_at < datetime(current_timestamp, '-{} SECONDS')
+        q = '''DELETE FROM full_hash WHERE expires_at < datetime(current_timestamp, ? || ' SECONDS')
         '''
         log.info('Cleaning up full_hash entries expired more than {} seconds ago.'.format(keep_expired_for))
         with self.get_cursor() as dbc:
-            dbc.execute(q.format(int(keep_expired_for)))
+            dbc.execute(q, [-int(keep_expired_for)])
 
     def update_hash_prefix_expiration(self, prefix_value, negative_cache_duration):
-        q = """UPDATE hash_prefix SET negative_expires_at=datetime(current_timestamp, '+{} SECONDS')
-            WHERE value=?"""
-        parameters = [sqlite3.Binary(prefix_value)]
+        self.update_hash_prefix_expirations([prefix_value], negative_cache_duration)
+
+    def update_hash_prefix_expirations(self, prefix_values, negative_cache_duration):
+        """Bump negative cache expiration of multiple hash prefixes at once."""
+        q = self._UPDATE_HASH_PREFIX_EXPIRATION_SQL
+        prefix_values = list(prefix_values)
         with self.get_cursor() as dbc:
-            dbc.execute(q.format(int(negative_cache_duration)), parameters)
+            # cue and value lists plus the duration have to fit into 999 variables allowed before SQLite 3.32
+            for update_batch in _padded_batches(prefix_values, batch_size=256):
+                cues = [v[0:4] if v is not None else None for v in update_batch]
+                parameters = [int(negative_cache_duration)] + cues + update_batch
+                dbc.execute(_sql_with_placeholders(q, len(update_batch)), parameters)
+
+    def _threat_list_rows(self):
+        """Rows of threat_list table, cached in memory for _threat_list_cache_ttl seconds."""
+        rows = self._threat_list_cache
+        if rows is None or time.monotonic() >= self._threat_list_cache_expires_at:
+            q = '''SELECT threat_type,platform_type,threat_entry_type,client_state FROM threat_list'''
+            with self.get_cursor() as dbc:
+                dbc.execute(q)
+                rows = dbc.fetchall()
+                self._threat_list_cache = rows
+                self._threat_list_cache_expires_at = time.monotonic() + self._threat_list_cache_ttl
+        return rows
 
     def get_threat_lists(self):
         """Get a list of known threat lists."""
-        q = '''SELECT threat_type,platform_type,threat_entry_type FROM threat_list'''
-        output = []
-        with self.get_cursor() as dbc:
-            dbc.execute(q)
-            for h in dbc.fetchall():
-                threat_type, platform_type, threat_entry_type = h
-                threat_list = ThreatList(threat_type, platform_type, threat_entry_type)
-                output.append(threat_list)
-        return output
+        return [ThreatList._make(h[:3]) for h in self._threat_list_rows()]
 
     def get_client_state(self):
         """Get a dict of known threat lists including clientState values."""
-        q = '''SELECT threat_type,platform_type,threat_entry_type,client_state FROM threat_list'''
         output = {}
-        with self.get_cursor() as dbc:
-            dbc.execute(q)
-            for h in dbc.fetchall():
-                threat_type, platform_type, threat_entry_type, client_state = h
-                threat_list_tuple = (threat_type, platform_type, threat_entry_type)
-                output[threat_list_tuple] = client_state
+        for h in self._threat_list_rows():
+            threat_type, platform_type, threat_entry_type, client_state = h
+            threat_list_tuple = (threat_type, platform_type, threat_entry_type)
+            output[threat_list_tuple] = client_state
         return output
 
     def add_threat_list(self, threat_list):
@@ -277,16 +464,22 @@ class SqliteStorage(object):
         '''
         params = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
         with self.get_cursor() as dbc:
+            self._threat_list_cache = None
             dbc.execute(q, params)
 
     def delete_threat_list(self, threat_list):
-        """Delete threat list entry."""
+        """Delete threat list entry along with its hash prefixes."""
         log.info('Deleting cached threat list "{}"'.format(repr(threat_list)))
+        # foreign keys are not enforced, cascade explicitly so that a reused list id never inherits stale prefixes
+        qp = '''DELETE FROM hash_prefix WHERE threat_list_id={}'''.format(self._THREAT_LIST_ID_SQL)
         q = '''DELETE FROM threat_list
                     WHERE threat_type=? AND platform_type=? AND threat_entry_type=?
         '''
         params = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
         with self.get_cursor() as dbc:
+            self._threat_list_cache = None
+            dbc.execute(qp, params)
+            self._hash_prefix_list_modified(dbc, threat_list)
             dbc.execute(q, params)
 
     def update_threat_list_client_state(self, threat_list, client_state):
@@ -294,85 +487,162 @@ class SqliteStorage(object):
         q = '''UPDATE threat_list SET timestamp=current_timestamp, client_state=?
             WHERE threat_type=? AND platform_type=? AND threat_entry_type=?'''
         with self.get_cursor() as dbc:
+            self._threat_list_cache = None
             params = [client_state, threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
             dbc.execute(q, params)
 
+    def _hash_prefix_list_modified(self, dbc, threat_list):
+        """Invalidate stored checksum and cue filters, must be called whenever hash prefixes are modified."""
+        q = '''UPDATE threat_list SET checksum=NULL
+            WHERE threat_type=? AND platform_type=? AND threat_entry_type=?'''
+        qg = "UPDATE metadata SET value=CAST(value AS INTEGER) + 1 WHERE name='hash_prefix_generation'"
+        params = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
+        dbc.execute(q, params)
+        dbc.execute(qg)
+
     def hash_prefix_list_checksum(self, threat_list):
-        """Returns SHA256 checksum for alphabetically-sorted concatenated list of hash prefixes"""
-        q = '''SELECT value FROM hash_prefix
+        """Returns SHA256 checksum for alphabetically-sorted concatenated list of hash prefixes
+
+        Checksum is stored along with threat list and only recalculated after the list is modified.
+        """
+        qc = '''SELECT checksum FROM threat_list
                 WHERE threat_type=? AND platform_type=? AND threat_entry_type=?
-                ORDER BY value
         '''
         params = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
         with self.get_cursor() as dbc:
-            dbc.execute(q, params)
-            all_hashes = b''.join(bytes(h[0]) for h in dbc.fetchall())
-            checksum = hashlib.sha256(all_hashes).digest()
-        return checksum
+            dbc.execute(qc, params)
+            row = dbc.fetchone()
+            if row is not None and row[0] is not None:
+                return row[0]
+        with self._write_lock:
+            # store the digest along with writes of an already open transaction, or commit it right away
+            tx = contextlib.nullcontext() if self.db.in_transaction else self.transaction()
+            with tx, self.get_cursor() as dbc:
+                return self._store_hash_prefix_list_checksum(dbc, threat_list)
+
+    def _store_hash_prefix_list_checksum(self, dbc, threat_list):
+        """Calculate checksum of the list from its hash prefixes and store it along with the threat list."""
+        q = '''SELECT value FROM hash_prefix WHERE threat_list_id={} ORDER BY value
+        '''.format(self._THREAT_LIST_ID_SQL)
+        qu = '''UPDATE threat_list SET checksum=?
+            WHERE threat_type=? AND platform_type=? AND threat_entry_type=?'''
+        params = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
+        checksum = hashlib.sha256()
+        buf = bytearray()
+        dbc.execute(q, params)
+        while True:
+            rows = dbc.fetchmany(8192)
+            if not rows:
+                break
+            buf += b''.join([r[0] for r in rows])
+            # feed hashlib with large contiguous buffers rather than row by row
+            if len(buf) >= 65536:
+                checksum.update(buf)
+                del buf[:]
+        checksum.update(buf)
+        digest = checksum.digest()
+        dbc.execute(qu, [digest] + params)
+        return digest
 
     def populate_hash_prefix_list(self, threat_list, hash_prefix_list):
         log.info('Storing {} entries of hash prefix list {}'.format(len(hash_prefix_list), str(threat_list)))
+        qs = '''INSERT OR IGNORE INTO hash_prefix_staging (value) VALUES (?)'''
+        qi = '''SELECT id FROM threat_list WHERE threat_type=? AND platform_type=? AND threat_entry_type=?'''
+        # WHERE true disambiguates ON CONFLICT from a join constraint, DO NOTHING skips duplicate prefixes only
         q = '''INSERT INTO hash_prefix
-                    (value, cue, threat_type, platform_type, threat_entry_type, timestamp)
-                VALUES
-                    (?, ?, ?, ?, ?, current_timestamp)
-        '''
-        with self.get_cursor() as dbc:
-            records = [[sqlite3.Binary(prefix_value), sqlite3.Binary(prefix_value[0:4]), threat_list.threat_type,
-                        threat_list.platform_type, threat_list.threat_entry_type] for prefix_value in hash_prefix_list]
-            dbc.executemany(q, records)
-
-    def get_hash_prefix_values_to_remove(self, threat_list, indices):
-        log.info('Removing {} records from threat list "{}"'.format(len(indices), str(threat_list)))
-        indices = set(indices)
-        q = '''SELECT value FROM hash_prefix
-                WHERE threat_type=? AND platform_type=? AND threat_entry_type=?
-                ORDER BY value
+                    (value, cue, threat_list_id, timestamp)
+                SELECT value, substr(value, 1, 4), ?, current_timestamp FROM hash_prefix_staging WHERE true
+                ON CONFLICT DO NOTHING
         '''
         params = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
-        values_to_remove = []
         with self.get_cursor() as dbc:
-            dbc.execute(q, params)
-            i = 0
-            for h in dbc.fetchall():
-                v = bytes(h[0])
-                if i in indices:
-                    values_to_remove.append(v)
-                i += 1
-        return values_to_remove
+            if not self.db.in_transaction:
+                # take the write lock upfront instead of upgrading from a read lock half way through the load
+                dbc.execute('BEGIN IMMEDIATE')
+            dbc.execute(qi, params)
+            row = dbc.fetchone()
+            if row is None:
+                raise ValueError('Threat list "{}" has to be added before its hash prefixes'.format(str(threat_list)))
+            threat_list_id = row[0]
+            # prefixes are sorted in the staging table, so they are merged into hash_prefix B-tree in key order
+            dbc.execute('CREATE TEMP TABLE IF NOT EXISTS hash_prefix_staging (value BLOB PRIMARY KEY) WITHOUT ROWID')
+            dbc.execute('DELETE FROM hash_prefix_staging')
+            dbc.executemany(qs, zip(hash_prefix_list))
+            dbc.execute(q, [threat_list_id])
+            dbc.execute('DELETE FROM hash_prefix_staging')
+            self._hash_prefix_list_modified(dbc, threat_list)
 
     def remove_hash_prefix_indices(self, threat_list, indices):
         """Remove records matching idices from a lexicographically-sorted local threat list."""
-        batch_size = 40
-        q = '''DELETE FROM hash_prefix
-                WHERE threat_type=? AND platform_type=? AND threat_entry_type=? AND value IN ({})
-        '''
-        prefixes_to_remove = self.get_hash_prefix_values_to_remove(threat_list, indices)
+        log.info('Removing {} records from threat list "{}"'.format(len(indices), str(threat_list)))
+        q = '''SELECT value FROM hash_prefix WHERE threat_list_id={} ORDER BY value
+        '''.format(self._THREAT_LIST_ID_SQL)
+        qd = '''DELETE FROM hash_prefix WHERE value=? AND threat_list_id={}
+        '''.format(self._THREAT_LIST_ID_SQL)
+        params = [threat_list.threat_type, threat_list.platform_type, threat_list.threat_entry_type]
+        wanted = sorted(set(indices))
+        if wanted and wanted[0] < 0:
+            raise ValueError('Invalid hash prefix index {} for threat list "{}"'.format(wanted[0], str(threat_list)))
+        values = []
         with self.get_cursor() as dbc:
-            for i in range(0, len(prefixes_to_remove), batch_size):
-                remove_batch = prefixes_to_remove[i:(i + batch_size)]
-                params = [
-                    threat_list.threat_type,
-                    threat_list.platform_type,
-                    threat_list.threat_entry_type
-                ] + [sqlite3.Binary(b) for b in remove_batch]
-                dbc.execute(q.format(','.join(['?'] * len(remove_batch))), params)
+            # resolve all indices in a single pass over the list before deleting, every delete shifts the ranks;
+            # only values to be removed are kept and the scan stops at the largest index
+            if wanted:
+                dbc.execute(q, params)
+                pending = iter(wanted)
+                next_index = next(pending)
+                for i, (value,) in enumerate(dbc):
+                    if i == next_index:
+                        values.append(value)
+                        next_index = next(pending, None)
+                        if next_index is None:
+                            break
+            if len(values) < len(wanted):
+                log.warning('{} of hash prefix indices are out of range of threat list "{}"'.format(
+                    len(wanted) - len(values), str(threat_list)))
+            dbc.executemany(qd, ((value, *params) for value in values))
+            self._hash_prefix_list_modified(dbc, threat_list)
 
     def dump_hash_prefix_values(self):
         """Export all hash prefix values.
 
-        Returns a list of known hash prefix values
+        Yields known hash prefix values committed to the DB, rows are fetched in chunks
+        so full dump never has to fit in memory
         """
         q = '''SELECT distinct value from hash_prefix'''
-        output = []
-        with self.get_cursor() as dbc:
-            dbc.execute(q)
-            output = [bytes(r[0]) for r in dbc.fetchall()]
-        return output
+        dbc = self._read_connection().execute(q)
+        try:
+            while True:
+                rows = dbc.fetchmany(8192)
+                if not rows:
+                    break
+                for r in rows:
+                    yield r[0]
+        finally:
+            dbc.close()
 
     def rollback(self):
         log.info('Rolling back DB transaction.')
-        self.db.rollback()
+        with self._write_lock:
+            self._threat_list_cache = None
+            self.db.rollback()
 
     def commit(self):
-        self.db.commit()
+        with self._write_lock:
+            self.db.commit()
+
+    def close(self):
+        """Close writer connection along with read-only connections opened by this thread and the cue filter.
+
+        Read-only connections of other threads are closed when those threads exit.
+        """
+        db = getattr(self._thread_local, 'db', None)
+        if db is not None:
+            db.close()
+            self._thread_local.db = None
+        with self._cue_filter_lock:
+            if self._cue_filter_db is not None:
+                self._cue_filter_db.close()
+                self._cue_filter_db = None
+        with self._write_lock:
+            self.db.close()
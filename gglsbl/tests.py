@@ -1,6 +1,12 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
 from gglsbl.protocol import URL
+from gglsbl.storage import SqliteStorage, ThreatList, HashPrefixList
 
 class SafeBrowsingListTestCase(unittest.TestCase):
     def setUp(self):
@@ -113,3 +119,163 @@ class SafeBrowsingListTestCase(unittest.TestCase):
         for k, v in self.url_permutations.items():
             p = list(URL.url_permutations(k))
             self.assertEqual(p, v)
+
+
+class SqliteStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage = SqliteStorage(os.path.join(self.tmp_dir, 'gsb_v4.db'))
+        self.threat_list = ThreatList('MALWARE', 'ANY_PLATFORM', 'URL')
+        self.storage.add_threat_list(self.threat_list)
+        self.prefixes = [bytes([i, i, i, i]) for i in range(0, 250, 10)]
+        self.storage.populate_hash_prefix_list(self.threat_list, HashPrefixList(4, b''.join(self.prefixes)))
+        self.storage.commit()
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_remove_hash_prefix_indices(self):
+        indices = [0, 3, 4, 24, 12, 12]
+        self.storage.remove_hash_prefix_indices(self.threat_list, indices + [25])
+        self.storage.commit()
+        expected = [p for i, p in enumerate(self.prefixes) if i not in indices]
+        self.assertEqual(sorted(self.storage.dump_hash_prefix_values()), expected)
+        with self.assertRaises(ValueError):
+            self.storage.remove_hash_prefix_indices(self.threat_list, [1, -1])
+
+    def test_update_hash_prefix_expirations(self):
+        self.storage.update_hash_prefix_expirations(self.prefixes[:2], -60)
+        self.storage.commit()
+        result = dict(self.storage.lookup_hash_prefix(self.prefixes[:3]))
+        self.assertEqual(result, {self.prefixes[0]: 1, self.prefixes[1]: 1, self.prefixes[2]: 0})
+
+    def test_hash_prefix_list_checksum(self):
+        self.assertEqual(self.storage.hash_prefix_list_checksum(self.threat_list),
+                         hashlib.sha256(b''.join(self.prefixes)).digest())
+        self.storage.remove_hash_prefix_indices(self.threat_list, [1])
+        self.assertEqual(self.storage.hash_prefix_list_checksum(self.threat_list),
+                         hashlib.sha256(b''.join(self.prefixes[:1] + self.prefixes[2:])).digest())
+        self.storage.delete_hash_prefix_list(self.threat_list)
+        self.assertEqual(self.storage.hash_prefix_list_checksum(self.threat_list), hashlib.sha256(b'').digest())
+
+    def test_cue_filter(self):
+        storage = SqliteStorage(os.path.join(self.tmp_dir, 'gsb_v4.db'), cue_filter=True)
+        new_prefix = b'\x07\x07\x07\x07'
+        self.assertEqual(storage.lookup_hash_prefix([self.prefixes[1], new_prefix]), [(self.prefixes[1], 0)])
+        # filter is refreshed after prefixes are committed through any connection
+        self.storage.populate_hash_prefix_list(self.threat_list, HashPrefixList(4, new_prefix))
+        self.storage.commit()
+        self.assertEqual(storage.lookup_hash_prefix([new_prefix]), [(new_prefix, 0)])
+        storage.populate_hash_prefix_list(self.threat_list, HashPrefixList(4, b'\x08\x08\x08\x08'))
+        storage.commit()
+        self.assertEqual(len(storage.lookup_hash_prefix([b'\x08\x08\x08\x08'])), 1)
+        # writes which leave the set of prefixes intact keep the filter
+        cue_filter = storage._cue_filter
+        self.storage.update_hash_prefix_expirations([new_prefix], 60)
+        self.storage.commit()
+        self.assertEqual(storage.lookup_hash_prefix([new_prefix]), [(new_prefix, 0)])
+        self.assertIs(storage._cue_filter, cue_filter)
+        storage.close()
+
+    def test_threat_list_cache(self):
+        self.assertEqual(self.storage.get_threat_lists(), [self.threat_list])
+        other_list = ThreatList('SOCIAL_ENGINEERING', 'ANY_PLATFORM', 'URL')
+        self.storage.add_threat_list(other_list)
+        self.assertEqual(set(self.storage.get_threat_lists()), {self.threat_list, other_list})
+        self.storage.rollback()
+        self.assertEqual(self.storage.get_threat_lists(), [self.threat_list])
+        self.assertEqual(self.storage.get_client_state(), {self.threat_list.as_tuple(): None})
+        self.storage.update_threat_list_client_state(self.threat_list, 'state')
+        self.assertEqual(self.storage.get_client_state(), {self.threat_list.as_tuple(): 'state'})
+        self.storage.delete_threat_list(self.threat_list)
+        self.assertEqual(self.storage.get_threat_lists(), [])
+
+    def test_transaction(self):
+        other_list = ThreatList('SOCIAL_ENGINEERING', 'ANY_PLATFORM', 'URL')
+        with self.assertRaises(ValueError):
+            with self.storage.transaction():
+                self.storage.add_threat_list(other_list)
+                raise ValueError()
+        self.assertEqual(self.storage.get_threat_lists(), [self.threat_list])
+        # writes made outside of transaction() are committed by the next block
+        self.storage.update_threat_list_client_state(self.threat_list, 'state')
+        with self.storage.transaction():
+            with self.storage.transaction():
+                self.storage.add_threat_list(other_list)
+            self.assertTrue(self.storage.db.in_transaction)
+        self.assertFalse(self.storage.db.in_transaction)
+        storage = SqliteStorage(os.path.join(self.tmp_dir, 'gsb_v4.db'))
+        self.assertEqual(storage.get_client_state(),
+                         {self.threat_list.as_tuple(): 'state', other_list.as_tuple(): None})
+        storage.close()
+
+    def test_update_hash_prefix_expirations_variable_limit(self):
+        self.storage.db.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        prefixes = [i.to_bytes(4, 'big') for i in range(1000, 1300)]
+        self.storage.populate_hash_prefix_list(self.threat_list, HashPrefixList(4, b''.join(prefixes)))
+        self.storage.update_hash_prefix_expirations(prefixes, -60)
+        self.storage.commit()
+        result = dict(self.storage.lookup_hash_prefix([p[0:4] for p in prefixes]))
+        self.assertEqual(result, dict.fromkeys(prefixes, 1))
+
+    def test_populate_unknown_threat_list(self):
+        other_list = ThreatList('SOCIAL_ENGINEERING', 'ANY_PLATFORM', 'URL')
+        with self.assertRaises(ValueError):
+            self.storage.populate_hash_prefix_list(other_list, HashPrefixList(4, b'\x07\x07\x07\x07'))
+        self.storage.rollback()
+        # prefixes already present in the list are skipped
+        self.storage.populate_hash_prefix_list(self.threat_list, HashPrefixList(4, b''.join(self.prefixes[:3])))
+        self.storage.commit()
+        self.assertEqual(sorted(self.storage.dump_hash_prefix_values()), self.prefixes)
+
+    def test_store_full_hashes(self):
+        full_hash = self.prefixes[1] + b'\x00' * 28
+        self.storage.store_full_hash(self.threat_list, full_hash, -60, 'LANDING')
+        self.storage.commit()
+        self.assertEqual(self.storage.lookup_full_hashes([full_hash]), [(self.threat_list, 1)])
+        # storing the same hash again updates it in place
+        self.storage.store_full_hashes([(self.threat_list, full_hash, 60, 'DISTRIBUTION')])
+        self.storage.commit()
+        self.assertEqual(self.storage.lookup_full_hashes([full_hash]), [(self.threat_list, 0)])
+        row = self.storage.db.execute('SELECT malware_threat_type FROM full_hash WHERE value=?', [full_hash]).fetchall()
+        self.assertEqual(row, [('DISTRIBUTION',)])
+
+    def test_lookup_multiple_padded_batches(self):
+        # 1100 cues are sent in batches of 512, 512 and 76 padded to 128
+        cues = [i.to_bytes(4, 'big') for i in range(1000, 2100)]
+        cues[100:100 + len(self.prefixes) * 40:40] = self.prefixes
+        result = self.storage.lookup_hash_prefix(cues)
+        self.assertEqual(sorted(value for value, _ in result), self.prefixes)
+        full_hashes = [c + b'\x00' * 28 for c in cues]
+        self.storage.store_full_hashes([(self.threat_list, full_hashes[-1], 60, None)])
+        self.storage.commit()
+        self.assertEqual(self.storage.lookup_full_hashes(full_hashes), [(self.threat_list, 0)])
+
+    def test_delete_and_readd_threat_list(self):
+        self.storage.delete_threat_list(self.threat_list)
+        other_list = ThreatList('SOCIAL_ENGINEERING', 'ANY_PLATFORM', 'URL')
+        self.storage.add_threat_list(other_list)
+        self.storage.commit()
+        self.assertEqual(list(self.storage.dump_hash_prefix_values()), [])
+        self.assertEqual(self.storage.hash_prefix_list_checksum(other_list), hashlib.sha256(b'').digest())
+
+    def test_hash_prefix_list_checksum_commits(self):
+        storage = SqliteStorage(os.path.join(self.tmp_dir, 'gsb_v4.db'), timeout=0)
+        storage.hash_prefix_list_checksum(self.threat_list)
+        self.assertFalse(storage.db.in_transaction)
+        # stored checksum does not keep the DB locked for other writers
+        self.storage.update_threat_list_client_state(self.threat_list, 'state')
+        self.storage.commit()
+        storage.close()
+        # within an open transaction checksum is stored along with its writes
+        with self.storage.transaction():
+            self.storage.remove_hash_prefix_indices(self.threat_list, [0])
+            self.storage.hash_prefix_list_checksum(self.threat_list)
+            self.assertTrue(self.storage.db.in_transaction)
+        self.assertEqual(self.storage.hash_prefix_list_checksum(self.threat_list),
+                         hashlib.sha256(b''.join(self.prefixes[1:])).digest())
+
+    def test_in_memory_db_rejected(self):
+        with self.assertRaises(ValueError):
+            SqliteStorage(':memory:')
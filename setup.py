@@ -11,7 +11,6 @@ setup(name='gglsbl',
         "Operating System :: POSIX",
         "Environment :: Console",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2",
         "Programming Language :: Python :: 3",
         "Topic :: Internet",
         "Topic :: Security",
@@ -23,6 +22,7 @@ setup(name='gglsbl',
     url='https://github.com/afilipovich/gglsbl',
     license='Apache2',
     packages=['gglsbl'],
+    python_requires='>=3.7',
     install_requires=['google-api-python-client>=1.4.2,<2'],
     scripts=['bin/gglsbl_client.py'],
 )